@@ -16,7 +16,22 @@ NAME = "Active-Alchemy"
 
 # ------------------------------------------------------------------------------
 
+import os
+import io
+import sys
+import csv
+import uuid
+import time
+import base64
+import shutil
+import numbers
+import decimal
 import threading
+import multiprocessing
+try:
+    from queue import Empty
+except ImportError:  # Python 2
+    from Queue import Empty
 import json
 import datetime
 import sqlalchemy
@@ -31,9 +46,15 @@ import sqlalchemy_utils as sa_utils
 import arrow
 
 DEFAULT_PER_PAGE = 10
+DEFAULT_BATCH_SIZE = 1000
+CSV_NULL = "\\N"
 
 utcnow = arrow.utcnow
 
+PY2 = sys.version_info[0] == 2
+text_type = unicode if PY2 else str
+string_types = (str, unicode) if PY2 else (str,)
+
 def _create_scoped_session(db, query_cls):
     session = sessionmaker(autoflush=True, autocommit=False,
                            bind=db.engine, query_cls=query_cls)
@@ -68,6 +89,238 @@ def _include_sqlalchemy(db):
     db.EmailType = sa_utils.EmailType
 
 
+def _export_value(column, v):
+    """Convert a column value to a JSON serializable one"""
+    if v is None:
+        return v
+    if isinstance(column.type, sqlalchemy.Enum) and column.type.enum_class:
+        return v.name
+    if _is_binary_column(column):
+        return base64.b64encode(v).decode("ascii")
+    if isinstance(v, datetime.timedelta):
+        return v.total_seconds()
+    if isinstance(v, (arrow.Arrow, datetime.date, datetime.time)):
+        return v.isoformat()
+    if isinstance(v, (decimal.Decimal, uuid.UUID)):
+        return text_type(v)
+    return v
+
+
+def _is_json_column(column):
+    return isinstance(column.type, (sa_utils.JSONType, sqlalchemy.JSON))
+
+
+def _is_binary_column(column):
+    return isinstance(column.type, sqlalchemy.types._Binary)
+
+
+def _csv_value(column, v):
+    """Convert an exported value to a CSV field. NULL is written as `CSV_NULL`
+    and a leading backslash is doubled, so empty strings and literal `\\N`
+    values are read back as they were.
+    """
+    if v is None:
+        return CSV_NULL
+    if _is_json_column(column):
+        return text_type(json.dumps(v))
+    if isinstance(v, float):
+        return text_type(repr(v))
+    if not isinstance(v, string_types):
+        return text_type(v)
+    if "\n" in v or "\r" in v:
+        raise ValueError("Column '%s' has a line break, which can not be"
+                         " exported to CSV. Use format='jsonl'" % column.name)
+    if v.startswith("\\"):
+        v = "\\" + v
+    return v
+
+
+def _csv_format(fields):
+    """Format text fields as a CSV line"""
+    if PY2:
+        buf = io.BytesIO()
+        csv.writer(buf).writerow([f.encode("utf-8") for f in fields])
+        return buf.getvalue().decode("utf-8")
+    buf = io.StringIO()
+    csv.writer(buf).writerow(fields)
+    return buf.getvalue()
+
+
+def _csv_parse(line):
+    """Parse a CSV line into text fields"""
+    if PY2:
+        return [f.decode("utf-8")
+                for f in next(csv.reader([line.encode("utf-8")]))]
+    return next(csv.reader([line]))
+
+
+def _portable_table(table):
+    """Copy of `table` holding only the column names, types and primary key,
+    so it can be pickled to the worker processes (column defaults may not be)
+    """
+    columns = [sqlalchemy.Column(c.name, c.type, primary_key=c.primary_key)
+               for c in table.columns]
+    return sqlalchemy.Table(table.name, MetaData(), *columns,
+                            schema=table.schema)
+
+
+def _pk_column(table):
+    return list(table.primary_key.columns)[0]
+
+
+def _import_value(column, value, format):
+    """Convert a value read from an export file back to the column type"""
+    if format == "csv":
+        if value == CSV_NULL:
+            return None
+        if value.startswith("\\"):
+            value = value[1:]
+    if value is None:
+        return None
+    if _is_json_column(column):
+        return json.loads(value) if format == "csv" else value
+    if isinstance(column.type, sqlalchemy.Enum) and column.type.enum_class:
+        return column.type.enum_class[value]
+    if _is_binary_column(column):
+        return base64.b64decode(value)
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if isinstance(column.type, sa_utils.ArrowType):
+        return arrow.get(value)
+    if issubclass(python_type, datetime.datetime):
+        value = arrow.get(value)
+        if getattr(column.type, "timezone", False):
+            return value.datetime
+        return value.naive
+    if issubclass(python_type, datetime.date):
+        return arrow.get(value).date()
+    if issubclass(python_type, datetime.time):
+        fmt = "%H:%M:%S.%f" if "." in value else "%H:%M:%S"
+        return datetime.datetime.strptime(value, fmt).time()
+    if issubclass(python_type, datetime.timedelta):
+        return datetime.timedelta(seconds=float(value))
+    if issubclass(python_type, (decimal.Decimal, uuid.UUID)):
+        return python_type(value)
+    if format == "csv":
+        if python_type is bool:
+            return value in ("True", "true", "1")
+        if python_type in (int, float):
+            return python_type(value)
+    return value
+
+
+def _read_lines(f, start, end):
+    """Yield the lines of the binary file `f` starting within [start, end).
+    A line crossing `start` belongs to the previous partition.
+    """
+    if start > 0:
+        f.seek(start - 1)
+        f.readline()
+    pos = f.tell()
+    while pos < end:
+        line = f.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line
+
+
+def _export_partition(engine, report, table, format, path, lower, upper,
+                      header, batch_size):
+    """Write the rows of `table` with a primary key within [lower, upper)
+    to `path`, calling `report(count)` every `batch_size` rows.
+    A `None` bound is unbounded. Returns the number of rows written
+    """
+    pk = _pk_column(table)
+    columns = list(table.columns)
+    names = [c.name for c in columns]
+    query = select([table]).order_by(pk)
+    if lower is not None:
+        query = query.where(pk >= lower)
+    if upper is not None:
+        query = query.where(pk < upper)
+
+    count = 0
+    conn = engine.connect().execution_options(stream_results=True)
+    try:
+        with io.open(path, "w", encoding="utf-8", newline="") as f:
+            if format == "csv" and header:
+                f.write(_csv_format(names))
+            result = conn.execute(query)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    values = [_export_value(c, v) for c, v in zip(columns, row)]
+                    if format == "csv":
+                        f.write(_csv_format([_csv_value(c, v)
+                                             for c, v in zip(columns, values)]))
+                    else:
+                        f.write(u"%s\n" % json.dumps(dict(zip(names, values))))
+                count += len(rows)
+                report(len(rows))
+    finally:
+        conn.close()
+    return count
+
+
+def _import_partition(engine, report, table, format, path, start, end,
+                      fieldnames, batch_size):
+    """Insert the rows of `path` starting within the bytes [start, end),
+    committing and calling `report(count)` every `batch_size` rows.
+    Returns the number of rows inserted
+    """
+    columns = table.columns
+
+    def flush(rows):
+        with engine.begin() as conn:
+            conn.execute(table.insert(), rows)
+        report(len(rows))
+        return len(rows)
+
+    count = 0
+    rows = []
+    with io.open(path, "rb") as f:
+        for line in _read_lines(f, start, end):
+            line = line.decode("utf-8")
+            if not line.strip():
+                continue
+            if format == "csv":
+                data = dict(zip(fieldnames, _csv_parse(line)))
+            else:
+                data = json.loads(line)
+            rows.append({k: _import_value(columns[k], v, format)
+                         for k, v in data.items() if k in columns})
+            if len(rows) >= batch_size:
+                count += flush(rows)
+                rows = []
+    if rows:
+        count += flush(rows)
+    return count
+
+
+# The engine and the progress queue of a worker process, set by _init_worker
+_worker = {}
+
+
+def _init_worker(info, options, queue):
+    """Pool initializer: each worker process opens its own engine"""
+    _worker["engine"] = sqlalchemy.create_engine(info, **options)
+    _worker["queue"] = queue
+
+
+def _run_in_worker(task):
+    """Pool entry point. Sends (rows, partitions done) to the progress queue"""
+    func, args = task
+    queue = _worker["queue"]
+    count = func(_worker["engine"], lambda n: queue.put((n, 0)), *args)
+    queue.put((0, 1))
+    return count
+
+
 class BaseQuery(Query):
 
     def get_or_error(self, uid, error):
@@ -98,6 +351,94 @@ class BaseQuery(Query):
         """
         return Paginator(self, **kwargs)
 
+    def soft_delete(self, batch_size=None):
+        """Soft delete all the records matching this query with set-based
+        UPDATE statements, without loading them.
+        :param batch_size: int - Number of rows per UPDATE/commit. By default
+                                 all rows are updated at once
+        :returns int: The number of affected rows
+        """
+        now = utcnow()
+        return self._batch_update({"is_deleted": True,
+                                   "deleted_at": now,
+                                   "updated_at": now}, batch_size)
+
+    def restore(self, batch_size=None):
+        """Soft undelete all the records matching this query.
+        As `Model.query()` excludes deleted records, query them with
+        `include_deleted=True`:
+
+            User.query(include_deleted=True).filter(...).restore()
+
+        :param batch_size: int - Number of rows per UPDATE/commit
+        :returns int: The number of affected rows
+        """
+        return self._batch_update({"is_deleted": False,
+                                   "deleted_at": None,
+                                   "updated_at": utcnow()}, batch_size)
+
+    def hard_delete(self, batch_size=None):
+        """Completely delete all the records matching this query with
+        set-based DELETE statements.
+        :param batch_size: int - Number of rows per DELETE/commit
+        :returns int: The number of affected rows
+        """
+        # 'fetch' removes the deleted instances from the session
+        return self._batched(lambda q: q.delete(synchronize_session="fetch"),
+                             batch_size)
+
+    def _batch_update(self, values, batch_size):
+        model = self.column_descriptions[0]["entity"]
+        if not hasattr(model, "is_deleted"):
+            raise TypeError("'%s' doesn't support soft delete" % model.__name__)
+        # Leave alone the rows already in the target state
+        if values["is_deleted"]:
+            query = self.filter(model.is_deleted != True)
+        else:
+            query = self.filter(model.is_deleted == True)
+        # commit() expires the loaded instances, so they will be
+        # refreshed with the new values on next access
+        return query._batched(lambda q: q.update(values, synchronize_session=False),
+                              batch_size)
+
+    def _batched(self, execute, batch_size):
+        """Run `execute` against this query, or against chunks of
+        `batch_size` rows selected by ascending primary key, committing
+        after each chunk so the locks are held one chunk at a time.
+        :returns int: The number of affected rows
+        """
+        # order_by(False) resets the ordering, which update()/delete() reject
+        query = self.order_by(False)
+        if not batch_size:
+            return self._commit(execute, query)
+
+        model = self.column_descriptions[0]["entity"]
+        pk = getattr(model, model.__primary_key__)
+        ids_query = query.with_entities(pk).order_by(pk)
+        count = 0
+        last = None
+        while True:
+            q = ids_query if last is None else ids_query.filter(pk > last)
+            ids = [row[0] for row in q.limit(batch_size)]
+            if not ids:
+                break
+            # Keep the query criteria, so rows changed by a concurrent
+            # writer since they were selected are left alone
+            count += self._commit(execute, query.filter(pk.in_(ids)))
+            if len(ids) < batch_size:
+                break
+            last = ids[-1]
+        return count
+
+    def _commit(self, execute, query):
+        try:
+            count = execute(query)
+            self.session.commit()
+            return count
+        except Exception as e:
+            self.session.rollback()
+            raise
+
 
 class ModelTableNameDescriptor(object):
     """
@@ -472,5 +813,178 @@ class ActiveAlchemy(object):
         meta.reflect(bind=self.engine)
         return meta
 
+    def export(self, model, path, format="jsonl", workers=1,
+               batch_size=DEFAULT_BATCH_SIZE, progress=None):
+        """Dump all the rows of a model's table to a file.
+        The table is partitioned by primary key ranges, each one streamed
+        to its own file by a worker process, then merged into `path`.
+        In CSV, NULL is written as `\\N`. Values with line breaks can only
+        be exported to jsonl.
+
+            db.export(User, "users.jsonl", workers=4)
+
+        :param model: The model (or Table) to export
+        :param path: The file to write
+        :param format: "jsonl" (one JSON object per line) or "csv"
+        :param workers: int - Number of worker processes. With 1, the
+                              export runs in the current process
+        :param batch_size: int - Number of rows fetched at once
+        :param progress: callable - Called with the stats dict every
+                                    `batch_size` rows
+        :returns dict: The stats: rows, partitions, done, seconds,
+                       rows_per_second
+        """
+        table = self._check_pipeline(model, format, workers)
+        bounds = self._pk_bounds(table, workers)
+        ranges = list(zip([None] + bounds, bounds + [None]))
+
+        single = len(ranges) == 1
+        parts = [path] if single else \
+            ["%s.part%s" % (path, n) for n in range(len(ranges))]
+        tasks = [(table, format, part, lo, hi, single, batch_size)
+                 for part, (lo, hi) in zip(parts, ranges)]
+        try:
+            stats = self._run_partitions(_export_partition, tasks, workers,
+                                         progress)
+            if not single:
+                with io.open(path, "w", encoding="utf-8", newline="") as f:
+                    if format == "csv":
+                        f.write(_csv_format([c.name for c in table.columns]))
+                    for part in parts:
+                        with io.open(part, "r", encoding="utf-8",
+                                     newline="") as p:
+                            shutil.copyfileobj(p, f)
+        except Exception as e:
+            if single and os.path.exists(path):
+                os.remove(path)
+            raise
+        finally:
+            if not single:
+                for part in parts:
+                    if os.path.exists(part):
+                        os.remove(part)
+        return stats
+
+    def import_(self, model, path, format="jsonl", workers=1,
+                batch_size=DEFAULT_BATCH_SIZE, progress=None):
+        """Load a file created with :meth:`export` into a model's table.
+        The file is partitioned by byte ranges, each one parsed and inserted
+        by a worker process, committing every `batch_size` rows.
+        If it fails, the rows committed so far are left in the table.
+
+            db.import_(User, "users.jsonl", workers=4)
+
+        :param model: The model (or Table) to import into
+        :param path: The file to read
+        :param format: "jsonl" or "csv"
+        :param workers: int - Number of worker processes. With 1, the
+                              import runs in the current process
+        :param batch_size: int - Number of rows per INSERT/commit
+        :param progress: callable - Called with the stats dict every
+                                    `batch_size` rows
+        :returns dict: The stats: rows, partitions, done, seconds,
+                       rows_per_second
+        """
+        table = self._check_pipeline(model, format, workers)
+        fieldnames = None
+        start = 0
+        if format == "csv":
+            with io.open(path, "rb") as f:
+                header = f.readline()
+            fieldnames = _csv_parse(header.decode("utf-8"))
+            start = len(header)
+
+        size = os.path.getsize(path)
+        offsets = sorted(set(start + (size - start) * n // workers
+                             for n in range(workers)))
+        ranges = zip(offsets, offsets[1:] + [size])
+        tasks = [(table, format, path, lo, hi, fieldnames, batch_size)
+                 for lo, hi in ranges if lo < hi]
+        return self._run_partitions(_import_partition, tasks, workers,
+                                    progress)
+
+    def _check_pipeline(self, model, format, workers):
+        if format not in ("jsonl", "csv"):
+            raise ValueError("Invalid format '%s'. Use 'jsonl' or 'csv'" % format)
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if workers > 1 and self.info.drivername == 'sqlite' \
+                and self.info.database in (None, '', ':memory:'):
+            raise ValueError(
+                'SQLite in-memory database can not be shared with'
+                ' worker processes (workers > 1).'
+            )
+        return _portable_table(getattr(model, '__table__', model))
+
+    def _pk_bounds(self, table, workers):
+        """Primary key values splitting the table in `workers` ranges.
+        Integer keys are split evenly between their min and max, other
+        keys at every count/workers rows.
+        """
+        if workers <= 1:
+            return []
+        pk = _pk_column(table)
+        lower, upper, count = self.engine.execute(
+            select([func.min(pk), func.max(pk), func.count()])).first()
+        if not count:
+            return []
+        if isinstance(lower, numbers.Integral):
+            step = (upper - lower) // workers + 1
+            return list(range(lower + step, upper + 1, step))
+        query = select([pk]).order_by(pk).limit(1)
+        bounds = [self.engine.execute(query.offset(count * n // workers))
+                      .scalar() for n in range(1, workers)]
+        return sorted(set(bounds))
+
+    def _run_partitions(self, func, tasks, workers, progress):
+        """Run `func(engine, report, *task)` for each task, in a pool of
+        `workers` processes each opening its own engine, or in the current
+        process. `report(count)` updates the stats and calls `progress`.
+        """
+        stats = {"rows": 0, "partitions": len(tasks), "done": 0,
+                 "seconds": 0, "rows_per_second": 0}
+        started = time.time()
+
+        def report(count, done=0):
+            stats["rows"] += count
+            stats["done"] += done
+            stats["seconds"] = time.time() - started
+            if stats["seconds"]:
+                stats["rows_per_second"] = stats["rows"] / stats["seconds"]
+            if progress:
+                progress(dict(stats))
+
+        if workers <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                func(self.engine, report, *task)
+                report(0, 1)
+            return stats
+
+        queue = multiprocessing.Queue()
+        pool = multiprocessing.Pool(min(workers, len(tasks)),
+                                    initializer=_init_worker,
+                                    initargs=(self.info, self.options, queue))
+        try:
+            result = pool.map_async(_run_in_worker,
+                                    [(func, task) for task in tasks])
+            while True:
+                try:
+                    report(*queue.get(timeout=0.1))
+                except Empty:
+                    if result.ready():
+                        break
+            # Raises the error of a failed worker
+            result.get()
+            # Every worker posted its (0, 1), it may still be in the pipe
+            while stats["done"] < len(tasks):
+                report(*queue.get())
+        except Exception as e:
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        return stats
+
     def __repr__(self):
         return "<SQLAlchemy('{0}')>".format(self.uri)
@@ -1,8 +1,22 @@
-from active_alchemy import ActiveAlchemy
+from active_alchemy import ActiveAlchemy, _read_lines
 import unittest
+import tempfile
+import shutil
+import datetime
+import decimal
+import json
+import enum
+import io
+import os
 
 table_name = "test_model"
 
+
+class Color(enum.Enum):
+    red = 1
+    blue = 2
+
+
 class TestActiveAlchemy(unittest.TestCase):
 
     @staticmethod
@@ -124,6 +138,91 @@ class TestActiveAlchemy(unittest.TestCase):
         self.assertIs(4, len(list(self.model.query())))
         self.assertIs(5, len(list(self.model.query(include_deleted=True))))
 
+    def test_query_soft_delete(self):
+        for n in range(5):
+            self.add_entry()
+        e = self.model(name="Jones", location="Miami").save()
+
+        count = self.model.query().filter(self.model.name == "Max")\
+                                  .soft_delete(batch_size=2)
+        self.assertEqual(5, count)
+        self.assertIs(1, len(list(self.model.query())))
+        self.assertFalse(e.is_deleted)
+
+    def test_query_restore(self):
+        e = self.add_entry()
+        self.add_entry()
+        self.model.query().soft_delete()
+        self.assertTrue(e.is_deleted)
+        self.assertIsNotNone(e.deleted_at)
+
+        count = self.model.query(include_deleted=True).restore(batch_size=1)
+        self.assertEqual(2, count)
+        self.assertFalse(e.is_deleted)
+        self.assertIsNone(e.deleted_at)
+        self.assertIs(2, len(list(self.model.query())))
+
+    def test_query_soft_delete_ordered(self):
+        for n in range(3):
+            self.add_entry()
+        self.model(name="Jones", location="Miami").save()
+
+        query = self.model.query().filter(self.model.name == "Max")\
+                                  .order_by(self.model.name)
+        self.assertEqual(3, query.soft_delete(batch_size=2))
+        self.assertEqual(3, self.model.query(include_deleted=True)
+                                      .filter(self.model.is_deleted == True)
+                                      .order_by(self.model.id).restore())
+        self.assertIs(4, len(list(self.model.query())))
+
+    def test_query_soft_delete_keeps_deleted(self):
+        e = self.add_entry().delete()
+        deleted_at = e.deleted_at
+        self.add_entry()
+
+        count = self.model.query(include_deleted=True).soft_delete(batch_size=1)
+        self.assertEqual(1, count)
+        self.assertEqual(deleted_at, e.deleted_at)
+
+        self.assertEqual(2, self.model.query(include_deleted=True).restore())
+        updated_at = e.updated_at
+        self.assertEqual(0, self.model.query(include_deleted=True).restore())
+        self.assertEqual(updated_at, e.updated_at)
+
+    def test_query_hard_delete(self):
+        for n in range(5):
+            self.add_entry()
+        self.add_entry().delete()
+
+        count = self.model.query(include_deleted=True).hard_delete(batch_size=2)
+        self.assertEqual(6, count)
+        self.assertIs(0, len(list(self.model.query(include_deleted=True))))
+
+    def test_export_import(self):
+        for n in range(5):
+            self.add_entry()
+        self.add_entry().delete()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for format in ("jsonl", "csv"):
+                path = os.path.join(tmpdir, "export." + format)
+                rows = [e.to_dict() for e in self.model.query(include_deleted=True)]
+
+                stats = self.db.export(self.model, path, format=format)
+                self.assertEqual(6, stats["rows"])
+                self.model.query(include_deleted=True).hard_delete()
+
+                stats = self.db.import_(self.model, path, format=format)
+                self.assertEqual(6, stats["rows"])
+                self.assertEqual(rows, [e.to_dict() for e in
+                                        self.model.query(include_deleted=True)])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_export_memory_workers(self):
+        with self.assertRaises(ValueError):
+            self.db.export(self.model, "export.jsonl", workers=2)
+
     def test_to_dict(self):
         e = self.add_entry()
         self.assertIsInstance(e.to_dict(), dict)
@@ -146,6 +245,156 @@ class TestActiveAlchemy(unittest.TestCase):
         self.assertIs(4, es.total_pages)
 
 
+class TestExportImport(unittest.TestCase):
+
+    @staticmethod
+    def create_test_model(db):
+        class Thing(db.Model):
+            name = db.Column(db.String(50), nullable=False)
+            day = db.Column(db.Date)
+            price = db.Column(db.Numeric(10, 2))
+            data = db.Column(db.JSONType)
+            color = db.Column(db.Enum(Color))
+            duration = db.Column(db.Interval)
+            seen_at = db.Column(db.SADateTime)
+            seen_time = db.Column(db.Time)
+        db.create_all()
+        return Thing
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def sqlite_db(self, name):
+        db = ActiveAlchemy('sqlite:///' + os.path.join(self.tmpdir, name))
+        return db, self.create_test_model(db)
+
+    def add_things(self, db, model, count):
+        for n in range(count):
+            db.add(model(name="x" * (n % 7) + str(n),
+                         day=datetime.date(2020, 1, 1 + n % 28),
+                         price=decimal.Decimal("%s.25" % n),
+                         data={"n": [n]},
+                         color=Color.red if n % 2 else Color.blue,
+                         duration=datetime.timedelta(days=n, microseconds=n),
+                         seen_at=datetime.datetime(2020, 1, 1, 12, n % 60, 30, n),
+                         seen_time=datetime.time(n % 24, 30, 15, n),
+                         is_deleted=n % 3 == 0))
+        db.commit()
+
+    def rows(self, model):
+        return [e.to_dict() for e in
+                model.query(include_deleted=True).order_by(model.id)]
+
+    def test_export_import_types(self):
+        db = ActiveAlchemy('sqlite://')
+        model = self.create_test_model(db)
+        self.add_things(db, model, 3)
+        for name in ("", "\\N", "\\x"):
+            model.create(name=name)
+        rows = self.rows(model)
+
+        for format in ("jsonl", "csv"):
+            path = os.path.join(self.tmpdir, "export." + format)
+            db.export(model, path, format=format)
+            model.query(include_deleted=True).hard_delete()
+            db.import_(model, path, format=format)
+            self.assertEqual(rows, self.rows(model))
+        self.assertIsNone(model.query().first().seen_at.tzinfo)
+
+    def test_export_import_schema(self):
+        db = ActiveAlchemy('sqlite://')
+        db.engine.execute("ATTACH DATABASE ':memory:' AS other")
+
+        class Other(db.Model):
+            __table_args__ = {"schema": "other"}
+            name = db.Column(db.String(50))
+        db.create_all()
+        Other.create(name="a")
+        Other.create(name="b")
+        rows = self.rows(Other)
+
+        path = os.path.join(self.tmpdir, "export.jsonl")
+        self.assertEqual(2, db.export(Other, path)["rows"])
+        Other.query(include_deleted=True).hard_delete()
+        self.assertEqual(2, db.import_(Other, path)["rows"])
+        self.assertEqual(rows, self.rows(Other))
+
+    def test_export_import_no_workers(self):
+        db = ActiveAlchemy('sqlite://')
+        model = self.create_test_model(db)
+        path = os.path.join(self.tmpdir, "export.jsonl")
+        with self.assertRaises(ValueError):
+            db.export(model, path, workers=0)
+        with self.assertRaises(ValueError):
+            db.import_(model, path, workers=0)
+
+    def test_export_import_workers(self):
+        db, model = self.sqlite_db("export.db")
+        self.add_things(db, model, 500)
+        rows = self.rows(model)
+
+        for format in ("jsonl", "csv"):
+            path = os.path.join(self.tmpdir, "export." + format)
+            stats = db.export(model, path, format=format, workers=3,
+                              batch_size=50)
+            self.assertEqual(500, stats["rows"])
+            self.assertEqual(3, stats["partitions"])
+
+            with io.open(path, encoding="utf-8") as f:
+                lines = f.read().splitlines()
+            if format == "csv":
+                lines = [l.split(",", 1)[0] for l in lines[1:]]
+            else:
+                lines = [json.loads(l)["id"] for l in lines]
+            self.assertEqual([r["id"] for r in rows],
+                             [int(l) for l in lines])
+
+            db2, model2 = self.sqlite_db("import.%s.db" % format)
+            stats = db2.import_(model2, path, format=format, workers=3,
+                                batch_size=50)
+            self.assertEqual(500, stats["rows"])
+            self.assertEqual(rows, self.rows(model2))
+
+    def test_export_progress(self):
+        db = ActiveAlchemy('sqlite://')
+        model = self.create_test_model(db)
+        self.add_things(db, model, 5)
+        path = os.path.join(self.tmpdir, "export.jsonl")
+        calls = []
+        db.export(model, path, batch_size=2, progress=calls.append)
+        self.assertEqual([2, 4, 5, 5], [c["rows"] for c in calls])
+        self.assertEqual(1, calls[-1]["done"])
+        self.assertEqual(["export.jsonl"], os.listdir(self.tmpdir))
+
+    def test_export_csv_line_break(self):
+        db = ActiveAlchemy('sqlite://')
+        model = self.create_test_model(db)
+        model.create(name="a\nb")
+        path = os.path.join(self.tmpdir, "export.csv")
+        with self.assertRaises(ValueError):
+            db.export(model, path, format="csv")
+        self.assertFalse(os.path.exists(path))
+
+    def test_read_lines(self):
+        lines = [b"a\n", b"bcd\n", b"\n", b"efghij\n", b"k"]
+        path = os.path.join(self.tmpdir, "lines")
+        with io.open(path, "wb") as f:
+            f.write(b"".join(lines))
+        size = os.path.getsize(path)
+
+        for offsets in ([0], [0, 1], [0, 2, 3], [0, 5, 6, 7], [0, 4, 14],
+                        list(range(size))):
+            bounds = zip(offsets, offsets[1:] + [size])
+            read = []
+            with io.open(path, "rb") as f:
+                for start, end in bounds:
+                    read.extend(_read_lines(f, start, end))
+            self.assertEqual(lines, read)
+
+
 if __name__ == '__main__':
     unittest.main()
 